@@ -1,10 +1,26 @@
 import os
 import json
 import requests
-from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 TRANSCODER_URL = os.environ.get('TRANSCODER_SERVICE_URL')
 
+# Module-level session so warm invocations reuse the TCP/TLS connection
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    # Only failed connections are retried: once the POST has been sent the
+    # transcode may be running, and resending it would start a duplicate
+    max_retries=Retry(
+        total=3,
+        connect=3,
+        read=0,
+        backoff_factor=0.5
+    )
+))
+
 def process_video_upload(event, context):
     """
     Cloud Function triggered by GCS upload to ode-islands-video-input/pending/
@@ -26,7 +42,7 @@ def process_video_upload(event, context):
         'video_id': video_id
     }
     
-    response = requests.post(
+    response = _session.post(
         f"{TRANSCODER_URL}/process",
         json=payload,
         timeout=3600
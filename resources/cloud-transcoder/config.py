@@ -8,7 +8,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '150k',
         'bufsize': '200k',
         'profile': 'baseline',
-        'level': '3.0'
+        'level': '3.0',
+        'preset': 'faster'
     },
     {
         'name': '240p',
@@ -19,7 +20,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '450k',
         'bufsize': '600k',
         'profile': 'baseline',
-        'level': '3.0'
+        'level': '3.0',
+        'preset': 'faster'
     },
     {
         'name': '360p',
@@ -30,7 +32,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '900k',
         'bufsize': '1200k',
         'profile': 'baseline',
-        'level': '3.1'
+        'level': '3.1',
+        'preset': 'faster'
     },
     {
         'name': '480p',
@@ -41,7 +44,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '1500k',
         'bufsize': '2000k',
         'profile': 'main',
-        'level': '3.1'
+        'level': '3.1',
+        'preset': 'faster'
     },
     {
         'name': '540p',
@@ -52,7 +56,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '2250k',
         'bufsize': '3000k',
         'profile': 'main',
-        'level': '4.0'
+        'level': '4.0',
+        'preset': 'faster'
     },
     {
         'name': '720p',
@@ -63,7 +68,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '3750k',
         'bufsize': '5000k',
         'profile': 'main',
-        'level': '4.0'
+        'level': '4.0',
+        'preset': 'faster'
     },
     {
         'name': '720p60',
@@ -75,6 +81,7 @@ LANDSCAPE_PROFILES = [
         'bufsize': '7000k',
         'profile': 'main',
         'level': '4.0',
+        'preset': 'faster',
         'fps': 60
     },
     {
@@ -86,7 +93,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '7500k',
         'bufsize': '10000k',
         'profile': 'high',
-        'level': '4.0'
+        'level': '4.0',
+        'preset': 'fast'
     },
     {
         'name': '1080p60',
@@ -98,6 +106,7 @@ LANDSCAPE_PROFILES = [
         'bufsize': '15000k',
         'profile': 'high',
         'level': '4.2',
+        'preset': 'fast',
         'fps': 60
     },
     {
@@ -109,7 +118,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '15000k',
         'bufsize': '20000k',
         'profile': 'high',
-        'level': '5.0'
+        'level': '5.0',
+        'preset': 'fast'
     },
     {
         'name': '2160p',
@@ -120,7 +130,8 @@ LANDSCAPE_PROFILES = [
         'maxrate': '30000k',
         'bufsize': '40000k',
         'profile': 'high',
-        'level': '5.1'
+        'level': '5.1',
+        'preset': 'fast'
     }
 ]
 
@@ -135,11 +146,38 @@ PORTRAIT_PROFILES = [
         'bufsize': '10000k',
         'profile': 'high',
         'level': '4.0',
+        'preset': 'fast',
         'orientation': 'portrait'
     }
 ]
 
+# Derived values computed once at import: bitrates in bits per second for
+# playlist bandwidths, and the landscape scale/pad filter for each rung
+for _profile in LANDSCAPE_PROFILES + PORTRAIT_PROFILES:
+    _profile['video_bps'] = int(_profile['video_bitrate'].rstrip('k')) * 1000
+    _profile['audio_bps'] = int(_profile['audio_bitrate'].rstrip('k')) * 1000
+    _profile['bandwidth_bps'] = _profile['video_bps'] + _profile['audio_bps']
+    _profile['scale_filter'] = (
+        f"scale={_profile['width']}:{_profile['height']}:force_original_aspect_ratio=decrease,"
+        f"pad={_profile['width']}:{_profile['height']}"
+    )
+
 QUALITY_PROFILES = LANDSCAPE_PROFILES
 
+# Premium rungs are deferred and only generated on demand (/transcode-variant)
+LAZY_PROFILE_NAMES = ['1080p60', '1440p', '2160p']
+EAGER_PROFILES = [p for p in LANDSCAPE_PROFILES if p['name'] not in LAZY_PROFILE_NAMES]
+LAZY_PROFILES = [p for p in LANDSCAPE_PROFILES if p['name'] in LAZY_PROFILE_NAMES]
+
+# Ladder dimensions in order. Widths and heights are both non-decreasing, so
+# the profiles that fit a source are always a prefix, found with bisect.
+EAGER_WIDTHS = [p['width'] for p in EAGER_PROFILES]
+EAGER_HEIGHTS = [p['height'] for p in EAGER_PROFILES]
+LAZY_WIDTHS = [p['width'] for p in LAZY_PROFILES]
+LAZY_HEIGHTS = [p['height'] for p in LAZY_PROFILES]
+
+for _dims in (EAGER_WIDTHS, EAGER_HEIGHTS, LAZY_WIDTHS, LAZY_HEIGHTS):
+    assert _dims == sorted(_dims), 'Landscape ladder must be ordered by size'
+
 GCS_INPUT_BUCKET = 'ode-islands-video-input'
 GCS_OUTPUT_BUCKET = 'ode-islands-video-cdn'
@@ -0,0 +1,7 @@
+# Loaded automatically by gunicorn from the working directory
+
+
+def post_worker_init(worker):
+    """Warm ffmpeg and the storage client before the worker takes requests"""
+    from transcode import warm_up
+    warm_up()
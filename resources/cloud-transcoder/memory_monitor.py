@@ -11,16 +11,33 @@ Features:
 """
 
 import os
+import queue
 import psutil
 import threading
 import time
 import logging
+from bisect import bisect_right
+from collections import deque
 from typing import Dict, Callable, Optional
 from dataclasses import dataclass
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Cloud Monitoring export cadence and buffer size
+METRIC_EXPORT_INTERVAL = 60.0
+METRIC_EXPORT_BUFFER = 200
+
+# /proc/meminfo lines read by MemoryMonitor, mapped to metric names
+MEMINFO_FIELDS = {
+    b'MemTotal': 'total',
+    b'MemFree': 'free',
+    b'MemAvailable': 'available',
+    b'Buffers': 'buffers',
+    b'Cached': 'cached',
+    b'SReclaimable': 'reclaimable'
+}
+
 @dataclass
 class MemoryThresholds:
     """Memory usage thresholds for triggering actions"""
@@ -35,7 +52,11 @@ class MemoryMetrics:
     used_mb: float
     available_mb: float
     percent: float
-    timestamp: datetime
+    timestamp_monotonic: float  # time.monotonic() when sampled
+    
+    def wall_time(self) -> datetime:
+        """Wall-clock time of the sample, derived only when needed"""
+        return datetime.fromtimestamp(time.time() - (time.monotonic() - self.timestamp_monotonic))
     
     def to_dict(self) -> Dict:
         return {
@@ -43,32 +64,117 @@ class MemoryMetrics:
             'used_mb': self.used_mb,
             'available_mb': self.available_mb,
             'percent': self.percent,
-            'timestamp': self.timestamp.isoformat()
+            'timestamp': self.wall_time().isoformat()
         }
 
 class MemoryMonitor:
     """Real-time memory monitoring with OOM prevention"""
     
-    def __init__(self, thresholds: Optional[MemoryThresholds] = None):
+    def __init__(self, thresholds: Optional[MemoryThresholds] = None, min_interval: float = 0.5):
         self.thresholds = thresholds or MemoryThresholds()
+        self.min_interval = min_interval  # Minimum seconds between psutil reads
         self.is_monitoring = False
         self.monitor_thread: Optional[threading.Thread] = None
         self.callbacks: Dict[str, Callable] = {}
         self.last_metrics: Optional[MemoryMetrics] = None
         self.warning_triggered = False
         self.critical_triggered = False
+        self.emergency_triggered = False
+        self._cache_ts = 0.0
+        self._cache_val: Optional[MemoryMetrics] = None
+        self._meminfo_fd = self._open_meminfo()
+        self.polling_interval = 10.0
+        self.sampling_interval = 0.5
+        self.burst_seconds = 10.0
+        self._burst_until = 0.0
+        self._wake = threading.Event()
+        
+        # Cloud Monitoring exporter state, initialized on first export
+        self._export_queue: queue.Queue = queue.Queue(maxsize=METRIC_EXPORT_BUFFER)
+        self._exporter_thread: Optional[threading.Thread] = None
+        self._export_disabled = False
+        self._metric_client = None
+        self._project_name = None
+        self._resource_labels: Dict[str, str] = {}
+        
+        # Sorted threshold levels; bisect_right(percent) indexes the handler
+        self._threshold_levels = [
+            self.thresholds.warning_percent,
+            self.thresholds.critical_percent,
+            self.thresholds.emergency_percent
+        ]
+        self._threshold_handlers = [
+            self._on_safe,
+            self._on_warning,
+            self._on_critical,
+            self._on_emergency
+        ]
+        
+    @staticmethod
+    def _open_meminfo() -> Optional[int]:
+        """Keep /proc/meminfo open so each poll is a single pread()"""
+        if not hasattr(os, 'pread'):
+            return None
+        try:
+            return os.open('/proc/meminfo', os.O_RDONLY)
+        except OSError:
+            return None
+            
+    def _read_meminfo(self) -> Optional[Dict[str, int]]:
+        """Read /proc/meminfo fields in bytes, or None if unavailable"""
+        if self._meminfo_fd is None:
+            return None
+            
+        try:
+            data = os.pread(self._meminfo_fd, 8192, 0)
+        except OSError:
+            return None
+            
+        fields = {}
+        for line in data.split(b'\n'):
+            name, _, value = line.partition(b':')
+            if name in MEMINFO_FIELDS:
+                fields[MEMINFO_FIELDS[name]] = int(value.split()[0]) * 1024
+        
+        if 'total' not in fields or 'available' not in fields:
+            return None
+        return fields
         
     def get_current_metrics(self) -> MemoryMetrics:
-        """Get current memory usage metrics"""
-        memory = psutil.virtual_memory()
+        """Get current memory usage metrics
         
-        return MemoryMetrics(
-            total_mb=memory.total / (1024 * 1024),
-            used_mb=memory.used / (1024 * 1024),
-            available_mb=memory.available / (1024 * 1024),
-            percent=memory.percent,
-            timestamp=datetime.now()
+        Readings younger than min_interval are served from cache so callers
+        polling at arbitrary rates don't multiply psutil overhead.
+        """
+        now = time.monotonic()
+        if self._cache_val is not None and now - self._cache_ts < self.min_interval:
+            return self._cache_val
+            
+        meminfo = self._read_meminfo()
+        if meminfo:
+            total = meminfo['total']
+            available = meminfo['available']
+            # Same derivation psutil uses for 'used' on Linux
+            used = total - meminfo.get('free', 0) - meminfo.get('buffers', 0) \
+                - meminfo.get('cached', 0) - meminfo.get('reclaimable', 0)
+            if used < 0:
+                used = total - meminfo.get('free', 0)
+            percent = round((total - available) / total * 100, 1)
+        else:
+            # Non-Linux fallback
+            memory = psutil.virtual_memory()
+            total, used, available, percent = memory.total, memory.used, memory.available, memory.percent
+        
+        metrics = MemoryMetrics(
+            total_mb=total / (1024 * 1024),
+            used_mb=used / (1024 * 1024),
+            available_mb=available / (1024 * 1024),
+            percent=percent,
+            timestamp_monotonic=now
         )
+        self._cache_val = metrics
+        self._cache_ts = now
+        return metrics
     
     def register_callback(self, level: str, callback: Callable):
         """Register callback for memory threshold events
@@ -79,35 +185,64 @@ class MemoryMonitor:
         """
         self.callbacks[level] = callback
         
-    def start_monitoring(self, interval_seconds: float = 5.0):
+    def start_monitoring(self, polling_interval: float = 10.0, sampling_interval: float = 0.5,
+                         burst_seconds: float = 10.0):
         """Start background memory monitoring
         
+        Memory is polled cheaply every polling_interval. While usage is above
+        the warning threshold, or for burst_seconds after request_burst(), it
+        is sampled every sampling_interval instead so allocation spikes are
+        caught before they become an OOM kill.
+        
         Args:
-            interval_seconds: How often to check memory (default 5s)
+            polling_interval: Steady-state check interval (default 10s)
+            sampling_interval: Check interval during bursts (default 0.5s)
+            burst_seconds: How long a requested burst lasts (default 10s)
         """
         if self.is_monitoring:
             logger.warning("Memory monitoring already running")
             return
             
+        self.polling_interval = polling_interval
+        self.sampling_interval = sampling_interval
+        self.burst_seconds = burst_seconds
         self.is_monitoring = True
+        self._wake.clear()
         self.monitor_thread = threading.Thread(
             target=self._monitor_loop,
-            args=(interval_seconds,),
             daemon=True
         )
         self.monitor_thread.start()
-        logger.info(f"Memory monitoring started (interval: {interval_seconds}s)")
+        logger.info(
+            f"Memory monitoring started (polling: {polling_interval}s, "
+            f"sampling: {sampling_interval}s)"
+        )
         
     def stop_monitoring(self):
         """Stop background memory monitoring"""
         self.is_monitoring = False
+        self._wake.set()
         if self.monitor_thread:
             self.monitor_thread.join(timeout=10)
         logger.info("Memory monitoring stopped")
         
-    def _monitor_loop(self, interval: float):
+    def request_burst(self):
+        """Sample at the high rate for a while, e.g. right after spawning an encoder"""
+        self._burst_until = time.monotonic() + self.burst_seconds
+        self._wake.set()
+        
+    def _next_interval(self, metrics: Optional[MemoryMetrics]) -> float:
+        """Pick the sleep before the next check"""
+        if time.monotonic() < self._burst_until:
+            return self.sampling_interval
+        if metrics and metrics.percent >= self.thresholds.warning_percent:
+            return self.sampling_interval
+        return self.polling_interval
+        
+    def _monitor_loop(self):
         """Background monitoring loop"""
         while self.is_monitoring:
+            metrics = None
             try:
                 metrics = self.get_current_metrics()
                 self.last_metrics = metrics
@@ -121,88 +256,136 @@ class MemoryMonitor:
             except Exception as e:
                 logger.error(f"Error in memory monitoring loop: {e}")
                 
-            time.sleep(interval)
+            # Sleep until the next check, waking early for a requested burst
+            self._wake.wait(self._next_interval(metrics))
+            self._wake.clear()
     
     def _check_thresholds(self, metrics: MemoryMetrics):
         """Check memory thresholds and trigger appropriate actions"""
+        level = bisect_right(self._threshold_levels, metrics.percent)
+        self._threshold_handlers[level](metrics)
         
-        # Emergency threshold (95%)
-        if metrics.percent >= self.thresholds.emergency_percent:
+    def _on_emergency(self, metrics: MemoryMetrics):
+        """Emergency threshold (95%)"""
+        if not self.emergency_triggered:
+            logger.critical(
+                f"EMERGENCY: Memory at {metrics.percent:.1f}% "
+                f"({metrics.used_mb:.0f}MB / {metrics.total_mb:.0f}MB)"
+            )
             if 'emergency' in self.callbacks:
-                logger.critical(
-                    f"EMERGENCY: Memory at {metrics.percent:.1f}% "
-                    f"({metrics.used_mb:.0f}MB / {metrics.total_mb:.0f}MB)"
-                )
                 self.callbacks['emergency'](metrics)
-                
-        # Critical threshold (85%)
-        elif metrics.percent >= self.thresholds.critical_percent:
-            if not self.critical_triggered:
-                logger.error(
-                    f"CRITICAL: Memory at {metrics.percent:.1f}% "
-                    f"({metrics.used_mb:.0f}MB / {metrics.total_mb:.0f}MB)"
-                )
-                if 'critical' in self.callbacks:
-                    self.callbacks['critical'](metrics)
-                self.critical_triggered = True
-                
-        # Warning threshold (70%)
-        elif metrics.percent >= self.thresholds.warning_percent:
-            if not self.warning_triggered:
-                logger.warning(
-                    f"WARNING: Memory at {metrics.percent:.1f}% "
-                    f"({metrics.used_mb:.0f}MB / {metrics.total_mb:.0f}MB)"
-                )
-                if 'warning' in self.callbacks:
-                    self.callbacks['warning'](metrics)
-                self.warning_triggered = True
-                
-        # Reset triggers when back to safe levels
-        else:
-            if self.critical_triggered or self.warning_triggered:
-                logger.info(
-                    f"Memory back to safe level: {metrics.percent:.1f}%"
-                )
-            self.warning_triggered = False
-            self.critical_triggered = False
+            self.emergency_triggered = True
+            
+    def _on_critical(self, metrics: MemoryMetrics):
+        """Critical threshold (85%)"""
+        if not self.critical_triggered:
+            logger.error(
+                f"CRITICAL: Memory at {metrics.percent:.1f}% "
+                f"({metrics.used_mb:.0f}MB / {metrics.total_mb:.0f}MB)"
+            )
+            if 'critical' in self.callbacks:
+                self.callbacks['critical'](metrics)
+            self.critical_triggered = True
+            
+    def _on_warning(self, metrics: MemoryMetrics):
+        """Warning threshold (70%)"""
+        if not self.warning_triggered:
+            logger.warning(
+                f"WARNING: Memory at {metrics.percent:.1f}% "
+                f"({metrics.used_mb:.0f}MB / {metrics.total_mb:.0f}MB)"
+            )
+            if 'warning' in self.callbacks:
+                self.callbacks['warning'](metrics)
+            self.warning_triggered = True
+            
+    def _on_safe(self, metrics: MemoryMetrics):
+        """Reset triggers when back to safe levels"""
+        if self.emergency_triggered or self.critical_triggered or self.warning_triggered:
+            logger.info(
+                f"Memory back to safe level: {metrics.percent:.1f}%"
+            )
+        self.warning_triggered = False
+        self.critical_triggered = False
+        self.emergency_triggered = False
     
     def _export_metrics(self, metrics: MemoryMetrics):
-        """Export metrics to Cloud Monitoring (if configured)"""
+        """Queue metrics for Cloud Monitoring export (if configured)
+        
+        The RPC happens on a separate exporter thread so a slow Cloud
+        Monitoring call never delays OOM detection on the monitoring thread.
+        """
         # Only export in Cloud Run environment
-        if not os.getenv('K_SERVICE'):
+        if self._export_disabled or not os.getenv('K_SERVICE') or not os.getenv('GOOGLE_CLOUD_PROJECT'):
             return
             
+        if self._exporter_thread is None:
+            self._exporter_thread = threading.Thread(target=self._exporter_loop, daemon=True)
+            self._exporter_thread.start()
+            
+        try:
+            self._export_queue.put_nowait(metrics)
+        except queue.Full:
+            pass
+            
+    def _exporter_loop(self):
+        """Buffer samples and flush them every METRIC_EXPORT_INTERVAL seconds"""
+        buffer = deque(maxlen=METRIC_EXPORT_BUFFER)
+        last_flush = time.monotonic()
+        
+        while not self._export_disabled:
+            timeout = max(0.0, METRIC_EXPORT_INTERVAL - (time.monotonic() - last_flush))
+            try:
+                buffer.append(self._export_queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+                
+            if len(buffer) == buffer.maxlen or time.monotonic() - last_flush >= METRIC_EXPORT_INTERVAL:
+                if buffer:
+                    self._write_time_series(list(buffer))
+                    buffer.clear()
+                last_flush = time.monotonic()
+                
+    def _write_time_series(self, samples):
+        """Write buffered samples as a single Cloud Monitoring point
+        
+        Cloud Monitoring accepts one point per time series per request (and at
+        most one every 5s), so the buffered window is reduced to its peak,
+        which is what matters for OOM alerting.
+        """
         try:
             from google.cloud import monitoring_v3
-            import google.auth
             
-            # Initialize client (uses default credentials in Cloud Run)
-            project_id = os.getenv('GOOGLE_CLOUD_PROJECT')
-            if not project_id:
-                return
+            if self._metric_client is None:
+                # Initialize client once (uses default credentials in Cloud Run)
+                self._metric_client = monitoring_v3.MetricServiceClient()
+                self._project_name = f"projects/{os.getenv('GOOGLE_CLOUD_PROJECT')}"
+                self._resource_labels = {
+                    'service_name': os.getenv('K_SERVICE', 'video-transcoder'),
+                    'revision_name': os.getenv('K_REVISION', 'unknown'),
+                    'location': os.getenv('REGION', 'us-central1')
+                }
                 
-            client = monitoring_v3.MetricServiceClient()
-            project_name = f"projects/{project_id}"
+            peak = max(samples, key=lambda m: m.percent)
+            end_time = samples[-1].wall_time().timestamp()
             
             # Create time series for memory usage
             series = monitoring_v3.TimeSeries()
             series.metric.type = "custom.googleapis.com/transcoder/memory/usage_percent"
             series.resource.type = "cloud_run_revision"
-            series.resource.labels["service_name"] = os.getenv('K_SERVICE', 'video-transcoder')
-            series.resource.labels["revision_name"] = os.getenv('K_REVISION', 'unknown')
-            series.resource.labels["location"] = os.getenv('REGION', 'us-central1')
+            series.resource.labels.update(self._resource_labels)
             
-            point = monitoring_v3.Point()
-            point.value.double_value = metrics.percent
-            point.interval.end_time.FromDatetime(metrics.timestamp)
+            point = monitoring_v3.Point({
+                'interval': {'end_time': {'seconds': int(end_time), 'nanos': int((end_time % 1) * 1e9)}},
+                'value': {'double_value': peak.percent}
+            })
             series.points = [point]
             
             # Write time series
-            client.create_time_series(name=project_name, time_series=[series])
+            self._metric_client.create_time_series(name=self._project_name, time_series=[series])
             
         except ImportError:
             # google-cloud-monitoring not installed
-            pass
+            self._export_disabled = True
         except Exception as e:
             logger.debug(f"Failed to export metrics to Cloud Monitoring: {e}")
     
@@ -232,12 +415,16 @@ class TranscoderMemoryManager:
         
     def start(self):
         """Start memory monitoring"""
-        self.monitor.start_monitoring(interval_seconds=5.0)
+        self.monitor.start_monitoring(polling_interval=10.0, sampling_interval=0.5)
         
     def stop(self):
         """Stop memory monitoring"""
         self.monitor.stop_monitoring()
         
+    def notify_allocation(self):
+        """Called when a memory-heavy job starts so the spike is sampled closely"""
+        self.monitor.request_burst()
+        
     def _handle_warning(self, metrics: MemoryMetrics):
         """Handle warning threshold (70%)"""
         logger.warning(
@@ -263,9 +450,11 @@ class TranscoderMemoryManager:
         
         # Log process info for debugging
         process = psutil.Process()
+        with process.oneshot():
+            memory_info = process.memory_info()
         logger.critical(
-            f"Process memory: RSS={process.memory_info().rss / (1024*1024):.0f}MB, "
-            f"VMS={process.memory_info().vms / (1024*1024):.0f}MB"
+            f"Process memory: RSS={memory_info.rss / (1024*1024):.0f}MB, "
+            f"VMS={memory_info.vms / (1024*1024):.0f}MB"
         )
         
     def should_skip_variant(self, priority_group: str) -> bool:
@@ -120,6 +120,19 @@ for folder in pending processing completed failed; do
     echo "" | gsutil cp - "gs://$INPUT_BUCKET/$folder/.keep" 2>/dev/null || true
 done
 
+# Processed inputs stay in pending/ (completed/ only gets a .done marker) so
+# on-demand variants can re-read them; expire them after 30 days
+cat > /tmp/lifecycle.json << 'EOF'
+{
+  "rule": [{
+    "action": {"type": "Delete"},
+    "condition": {"age": 30, "matchesPrefix": ["pending/"]}
+  }]
+}
+EOF
+gsutil lifecycle set /tmp/lifecycle.json "gs://$INPUT_BUCKET" &> /dev/null
+rm /tmp/lifecycle.json
+
 # CDN bucket
 if gsutil ls -p "$PROJECT_ID" "gs://$CDN_BUCKET" &> /dev/null; then
     echo -e "${YELLOW}!${NC} CDN bucket already exists"
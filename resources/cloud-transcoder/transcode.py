@@ -1,51 +1,563 @@
 #!/usr/bin/env python3
 
 import os
+import io
+import re
+import asyncio
 import json
 import subprocess
 import tempfile
 import shutil
+import functools
+import random
+import signal
+from bisect import bisect_right
 import concurrent.futures
-from threading import Semaphore
+from collections import defaultdict, deque
+from contextlib import contextmanager, asynccontextmanager
+import threading
 from pathlib import Path
-from google.cloud import storage
 from flask import Flask, request, jsonify
-from config import QUALITY_PROFILES, LANDSCAPE_PROFILES, PORTRAIT_PROFILES, GCS_INPUT_BUCKET, GCS_OUTPUT_BUCKET
+from config import (
+    QUALITY_PROFILES, LANDSCAPE_PROFILES, PORTRAIT_PROFILES, EAGER_PROFILES, LAZY_PROFILES,
+    EAGER_WIDTHS, EAGER_HEIGHTS, LAZY_WIDTHS, LAZY_HEIGHTS,
+    GCS_INPUT_BUCKET, GCS_OUTPUT_BUCKET
+)
 from memory_monitor import memory_manager
 
+try:
+    # Optional: reads stream metadata in-process instead of spawning ffprobe
+    import av
+except ImportError:
+    av = None
+
 app = Flask(__name__)
-storage_client = storage.Client()
 
-# Resource management to prevent OOM
-MAX_PARALLEL_JOBS = int(os.environ.get('MAX_PARALLEL_JOBS', 4))
-memory_semaphore = Semaphore(MAX_PARALLEL_JOBS)
+# Keep-alive connections shared by all GCS calls (uploads, status, renames)
+HTTP_POOL_SIZE = 64
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    """Shared GCS client, created on first use
+    
+    Importing google.cloud.storage pulls in the auth and transport stack, so
+    it is deferred until a request needs it rather than paid at import time.
+    
+    The default requests pool keeps 10 connections per host, fewer than the
+    upload workers, so extra uploads would open and discard TLS connections.
+    """
+    from google.cloud import storage
+    from requests.adapters import HTTPAdapter
+    
+    client = storage.Client()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=3)
+    client._http.mount('https://', adapter)
+    return client
+
+
+# Resource management to prevent OOM. MAX_PARALLEL_JOBS is the budget for the
+# whole container, shared evenly between the gunicorn workers serving it
+GUNICORN_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+MAX_PARALLEL_JOBS = max(1, int(os.environ.get('MAX_PARALLEL_JOBS', 4)) // GUNICORN_WORKERS)
+
+def _threads_per_invocation():
+    """Encoder threads per ffmpeg invocation, defaulting to an even share of the CPUs
+    
+    Left to auto-detect, every parallel x264 would start ~cpu_count() threads
+    and oversubscribe the machine. FFMPEG_THREADS_PER_INVOCATION overrides it.
+    The budget covers the whole ladder pass and is split between its rungs
+    by split_encoder_threads; a pass with more rungs than the budget still
+    gives each rung one thread.
+    """
+    value = os.environ.get('FFMPEG_THREADS_PER_INVOCATION')
+    if value is None:
+        container_jobs = MAX_PARALLEL_JOBS * GUNICORN_WORKERS
+        return max(1, (os.cpu_count() or container_jobs) // container_jobs)
+    
+    threads = int(value)
+    if not 1 <= threads <= 64:
+        raise ValueError(f"FFMPEG_THREADS_PER_INVOCATION must be between 1 and 64, got {threads}")
+    return threads
+
+
+FFMPEG_THREADS = _threads_per_invocation()
+# Rough working set of one encode, used to shrink parallelism under memory pressure
+ENCODE_MEMORY_MB = int(os.environ.get('ENCODE_MEMORY_MB', 1024))
+
+# Input is downloaded in chunks so encoding can start before the download ends
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+PROBE_BYTES = 8 * 1024 * 1024
+STREAM_READ_SIZE = 1024 * 1024
+
+# Free tmpfs needed before segment output is placed on /dev/shm. Docker's
+# default /dev/shm is only 64 MiB, far too small for in-flight segments.
+SHM_MIN_FREE_BYTES = int(os.environ.get('SHM_MIN_FREE_MB', 2048)) * 1024 * 1024
+
+
+def _segment_scratch_parent():
+    """/dev/shm if it exists and has room for segments, else the temp dir"""
+    try:
+        if shutil.disk_usage('/dev/shm').free >= SHM_MIN_FREE_BYTES:
+            return '/dev/shm'
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+
+# Per-video working directories live under scratch roots that persist for the
+# life of the container. Segments go to tmpfs when there is room, keeping their
+# writes in RAM; the (potentially multi-GB) input always stays off tmpfs.
+SCRATCH_ROOT = os.environ.get('SCRATCH_DIR') or os.path.join(
+    _segment_scratch_parent(), f"transcoder-{os.getpid()}"
+)
+INPUT_ROOT = os.environ.get('INPUT_DIR') or os.path.join(
+    tempfile.gettempdir(), f"transcoder-{os.getpid()}"
+)
+
+# Lines of ffmpeg stderr kept per encode for error reports; stderr is read in
+# fixed-size chunks and longer lines are cut, so no log line can fail an encode
+STDERR_TAIL_LINES = 200
+STDERR_READ_SIZE = 64 * 1024
+STDERR_LINE_MAX = 4096
+
+# Longest a single ladder pass may run before its ffmpeg is killed
+ENCODE_TIMEOUT = int(os.environ.get('ENCODE_TIMEOUT', 3600))
+
+# Segment length; every rung is keyframed on the same boundaries so players
+# can switch renditions at any segment without stalling
+SEGMENT_SECONDS = 2
+
+# Output segments are uploaded concurrently over the shared client
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 16))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_TIMEOUT = 120
+# Files above this are split into parts uploaded in parallel (XML multipart)
+LARGE_UPLOAD_BYTES = 32 * 1024 * 1024
+SEGMENT_POLL_INTERVAL = 1.0
+
+# Progress writes to status.json are coalesced to at most one per interval
+STATUS_FLUSH_INTERVAL = 2.0
+# Conditional read-modify-write attempts before giving up on status.json
+STATUS_UPDATE_ATTEMPTS = 5
+_SEG_RE = re.compile(r'segment_\d+\.ts')
+
+# Content-adaptive preset selection (see select_preset)
+X264_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow']
+PACKET_SAMPLE_SECONDS = 10
+EASY_CONTENT_BPP = 0.05
+EASY_CONTENT_MOTION = 0.5
+HARD_CONTENT_MOTION = 1.5
 
 # Start memory monitoring
 memory_manager.start()
 
 
-def get_video_dimensions(input_file):
-    cmd = [
-        'ffprobe',
+# Hardware encoders in order of preference, with the ffmpeg options that open
+# their device and the filter that hands them frames in a format they accept
+HW_DEVICE_ARGS = {
+    'h264_nvenc': [],
+    'h264_qsv': ['-init_hw_device', 'qsv=hw', '-filter_hw_device', 'hw'],
+    'h264_vaapi': ['-vaapi_device', os.environ.get('VAAPI_DEVICE', '/dev/dri/renderD128')]
+}
+HW_UPLOAD_FILTER = {
+    'h264_nvenc': '',
+    'h264_qsv': ',format=nv12',
+    'h264_vaapi': ',format=nv12,hwupload'
+}
+
+
+def detect_video_encoder():
+    """Pick the first hardware encoder ffmpeg can actually open, otherwise libx264
+    
+    An ffmpeg build can list an encoder without the GPU or driver behind it,
+    so each listed candidate gets a one-frame test encode.
+    """
+    override = os.environ.get('VIDEO_ENCODER')
+    if override:
+        if override != 'libx264' and override not in HW_DEVICE_ARGS:
+            supported = ', '.join(['libx264'] + list(HW_DEVICE_ARGS))
+            raise ValueError(f"VIDEO_ENCODER must be one of {supported}, got {override}")
+        return override
+    
+    try:
+        listed = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return 'libx264'
+    
+    for encoder, device_args in HW_DEVICE_ARGS.items():
+        if encoder not in listed:
+            continue
+        
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error'] + device_args + [
+            '-f', 'lavfi', '-i', 'nullsrc=s=256x144',
+            '-vf', f"null{HW_UPLOAD_FILTER[encoder]}",
+            '-frames:v', '1',
+            '-c:v', encoder,
+            '-f', 'null', '-'
+        ]
+        try:
+            if subprocess.run(cmd, capture_output=True, timeout=30).returncode == 0:
+                return encoder
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+    
+    return 'libx264'
+
+
+VIDEO_ENCODER = detect_video_encoder()
+print(f"Video encoder: {VIDEO_ENCODER}")
+
+# Every ffmpeg process is spawned and awaited on this one loop, so concurrent
+# encodes across requests share a single thread and one MAX_PARALLEL_JOBS gate
+_encode_loop = asyncio.new_event_loop()
+threading.Thread(target=_encode_loop.run_forever, daemon=True, name='encode-loop').start()
+
+
+def run_encode(coro):
+    """Run a coroutine on the encode loop and block until it returns"""
+    return asyncio.run_coroutine_threadsafe(coro, _encode_loop).result()
+
+
+async def _create_semaphore(value):
+    # Created on the encode loop so it is bound to that loop
+    return asyncio.Semaphore(value)
+
+
+encode_slots = run_encode(_create_semaphore(MAX_PARALLEL_JOBS))
+
+
+class EncoderSessions:
+    """Budget of hardware encoder sessions shared by every pass on the encode loop
+    
+    A ladder pass opens one session per rendition, so it reserves them all at
+    once; taking them one at a time could leave two passes each holding part
+    of what they need. sessions=None means no limit.
+    """
+    
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self._free = sessions
+        self._changed = asyncio.Condition()
+    
+    @asynccontextmanager
+    async def reserve(self, count):
+        if self.sessions is None:
+            yield
+            return
+        
+        count = min(count, self.sessions)  # A pass wider than the budget runs alone
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._free >= count)
+            self._free -= count
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self._free += count
+                self._changed.notify_all()
+
+
+async def _create_encoder_sessions(sessions):
+    # Created on the encode loop so its condition is bound to that loop
+    return EncoderSessions(sessions)
+
+
+# Consumer GPUs cap concurrent NVENC sessions per machine (datacenter parts can
+# raise this), so the container's budget is split between the gunicorn workers
+encoder_sessions = run_encode(_create_encoder_sessions(
+    max(1, int(os.environ.get('NVENC_MAX_SESSIONS', 8)) // GUNICORN_WORKERS)
+    if VIDEO_ENCODER == 'h264_nvenc' else None
+))
+
+
+@contextmanager
+def scratch_directory(video_id, root=SCRATCH_ROOT):
+    """Create a working directory for one video, removing only that subtree afterwards"""
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f"{video_id}-", dir=root)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class InputDownload:
+    """Download a blob to a local file in the background
+    
+    Readers can follow the file while it is still being written, which lets
+    ffprobe and the first ffmpeg pass overlap with the download instead of
+    waiting for the whole (potentially multi-GB) input to land on disk.
+    """
+    
+    def __init__(self, blob, path):
+        self.blob = blob
+        self.path = path
+        self.bytes_written = 0
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+        self._file = open(path, 'wb')
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._download, daemon=True)
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        # Stop writing into a directory that is about to be removed
+        self.cancelled = True
+        self._thread.join()
+    
+    def write(self, data):
+        # Called by the storage client for every downloaded chunk
+        if self.cancelled:
+            raise Exception("Download cancelled")
+        self._file.write(data)
+        self._file.flush()
+        with self._cond:
+            self.bytes_written += len(data)
+            self._cond.notify_all()
+    
+    def _download(self):
+        try:
+            self.blob.chunk_size = DOWNLOAD_CHUNK_SIZE
+            self.blob.download_to_file(self, raw_download=True)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._file.close()
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+    
+    def wait_for(self, size):
+        """Block until at least size bytes are on disk or the download ends"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.finished or self.bytes_written >= size)
+    
+    def wait(self):
+        """Block until the download completes, re-raising any download error"""
+        self._thread.join()
+        if self.error:
+            raise Exception(f"Input download failed: {self.error}")
+        return self.path
+    
+    def follow(self):
+        """Yield the file's contents as they are written, ending with the download"""
+        with open(self.path, 'rb') as f:
+            while True:
+                done = self.finished
+                chunk = f.read(STREAM_READ_SIZE)
+                if chunk:
+                    yield chunk
+                elif done:
+                    break
+                else:
+                    with self._cond:
+                        self._cond.wait(timeout=1)
+        
+        if self.error:
+            raise Exception(f"Input download failed: {self.error}")
+
+
+class SegmentUploader:
+    """Upload HLS segments to GCS as soon as ffmpeg closes them
+    
+    With hls_flags temp_file, ffmpeg writes each segment as segment_N.ts.tmp
+    and renames it once complete, so any segment found under its final name
+    is finished. A poller over the output directory streams those to GCS
+    while encoding continues; the VOD playlists are only written at the end
+    and cannot be used for this. Uploaded segments are removed locally,
+    keeping the scratch footprint to roughly the in-progress segment per
+    variant. Segments that fail to upload stay on disk and are picked up by
+    the final upload_to_gcs sweep.
+    """
+    
+    def __init__(self, local_dir, video_id):
+        self.local_dir = local_dir
+        self.video_id = video_id
+        self.bucket = get_storage_client().bucket(GCS_OUTPUT_BUCKET)
+        self.uploaded = defaultdict(set)  # directory -> segment names uploaded from it
+        self._seen = set()
+        self._futures = []
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+    
+    def __enter__(self):
+        os.makedirs(self.local_dir, exist_ok=True)
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.finish()
+    
+    def finish(self):
+        """Upload everything ffmpeg has finished and wait for in-flight uploads"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.scan()
+        self._executor.shutdown(wait=True)
+        count = sum(len(names) for names in self.uploaded.values())
+        print(f"✓ Streamed {count} segments to GCS during encoding")
+    
+    def _watch(self):
+        while not self._stop.wait(SEGMENT_POLL_INTERVAL):
+            try:
+                self.scan()
+            except Exception as e:
+                print(f"Segment scan failed: {e}")
+    
+    def scan(self):
+        with self._scan_lock:
+            self._scan()
+    
+    def _scan(self):
+        for entry in _iter_files(self.local_dir):
+            if not _SEG_RE.fullmatch(entry.name):
+                continue  # Playlists and in-progress .tmp segments
+            
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Uploaded and removed since the listing
+            
+            # A re-run of the same ladder rewrites segments under the same name
+            key = (entry.path, stat.st_mtime_ns)
+            if key not in self._seen:
+                self._seen.add(key)
+                self._futures.append(self._executor.submit(self._upload, entry.path))
+    
+    def _upload(self, path):
+        relative_path = path[len(self.local_dir) + 1:]
+        blob = self.bucket.blob(f"videos/{self.video_id}/{relative_path}")
+        try:
+            blob.upload_from_filename(path, checksum='crc32c', timeout=UPLOAD_TIMEOUT)
+        except Exception as e:
+            print(f"Segment upload failed, will retry at the end: {relative_path}: {e}")
+            return
+        
+        os.unlink(path)
+        with self._lock:
+            self.uploaded[os.path.dirname(path)].add(os.path.basename(path))
+
+
+def probe_input(download):
+    """Probe the input from its first chunk, falling back to the full download
+    
+    Files with their index at the front (faststart MP4, MKV, WebM) can be
+    probed from the first few MB; anything else needs the whole file.
+    """
+    download.wait_for(PROBE_BYTES)
+    if not download.finished:
+        # Pipe a fixed prefix rather than letting ffprobe race the growing file
+        with open(download.path, 'rb') as f:
+            head = f.read(PROBE_BYTES)
+        try:
+            return probe_video_metadata(download.path, head=head)
+        except Exception as e:
+            print(f"Partial probe failed, waiting for full download: {e}")
+    
+    return probe_video_metadata(download.wait())
+
+
+def run_ffprobe(args, input_file, head=None):
+    """Run ffprobe on input_file, or on the leading bytes in head via stdin"""
+    cmd = ['ffprobe'] + args + ['-' if head is not None else input_file]
+    result = subprocess.run(cmd, input=head, capture_output=True, timeout=30)
+    result.stdout = result.stdout.decode('utf-8', errors='replace')
+    result.stderr = result.stderr.decode('utf-8', errors='replace')
+    return result
+
+
+def probe_streams_pyav(input_file, head=None):
+    """Stream info shaped like ffprobe's JSON output, read in-process with PyAV
+    
+    Packet statistics for the first video stream come from the same open
+    container, so a PyAV probe never forks ffprobe. Returns (data, packet_stats).
+    """
+    def rate(fraction):
+        return f"{fraction.numerator}/{fraction.denominator}" if fraction else '0/0'
+    
+    source = io.BytesIO(head) if head is not None else input_file
+    with av.open(source, mode='r', metadata_errors='ignore') as container:
+        streams = []
+        for stream in container.streams:
+            entry = {'codec_type': stream.type}
+            if stream.type == 'video':
+                entry.update({
+                    'width': stream.codec_context.width,
+                    'height': stream.codec_context.height,
+                    'duration': float(stream.duration * stream.time_base) if stream.duration else 0,
+                    'r_frame_rate': rate(stream.base_rate),
+                    'avg_frame_rate': rate(stream.average_rate),
+                    'codec_name': stream.codec_context.name,
+                    'bit_rate': stream.codec_context.bit_rate,
+                    'nb_frames': stream.frames
+                })
+            streams.append(entry)
+        
+        packet_stats = {}
+        video = next((s for s in container.streams if s.type == 'video'), None)
+        if video is not None:
+            packet_stats = summarise_packets(_sample_packets_pyav(container, video))
+        
+        return {'streams': streams, 'format': {'bit_rate': container.bit_rate}}, packet_stats
+
+
+def _sample_packets_pyav(container, stream):
+    """Yield (size, is_keyframe) for the first PACKET_SAMPLE_SECONDS of stream"""
+    start = None
+    try:
+        for packet in container.demux(stream):
+            if not packet.size:
+                continue  # Flush packet at end of stream
+            if packet.pts is not None:
+                seconds = float(packet.pts * packet.time_base)
+                start = seconds if start is None else start
+                if seconds - start > PACKET_SAMPLE_SECONDS:
+                    return
+            yield packet.size, packet.is_keyframe
+    except av.error.FFmpegError:
+        return  # A truncated head ends the sample early
+
+
+def probe_video_metadata(input_file, head=None):
+    args = [
         '-v', 'error',
-        '-select_streams', 'v:0',
-        '-show_entries', 'stream=width,height,duration,r_frame_rate,codec_name',
-        '-of', 'json',
-        input_file
+        '-show_entries', 'stream=codec_type,width,height,duration,r_frame_rate,avg_frame_rate,codec_name,bit_rate,nb_frames:format=bit_rate',
+        '-of', 'json'
     ]
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        data = None
+        packet_stats = None
+        if av is not None:
+            try:
+                data, packet_stats = probe_streams_pyav(input_file, head)
+            except Exception as e:
+                print(f"PyAV probe failed, falling back to ffprobe: {e}")
         
-        if result.returncode != 0:
-            raise Exception(f"FFprobe failed: {result.stderr}")
-        
-        data = json.loads(result.stdout)
+        if data is None:
+            result = run_ffprobe(args, input_file, head)
+            
+            if result.returncode != 0:
+                raise Exception(f"FFprobe failed: {result.stderr}")
+            
+            data = json.loads(result.stdout)
         
-        if 'streams' not in data or len(data['streams']) == 0:
+        streams = data.get('streams', [])
+        video_streams = [s for s in streams if s.get('codec_type') == 'video']
+        if not video_streams:
             raise Exception("No video stream found (audio-only file?)")
         
-        stream = data['streams'][0]
+        stream = video_streams[0]
         width = int(stream.get('width', 0))
         height = int(stream.get('height', 0))
         duration = float(stream.get('duration', 0))
@@ -69,13 +581,31 @@ def get_video_dimensions(input_file):
         except:
             print(f"⚠️ Warning: Could not parse frame rate: {fps_str}")
         
+        try:
+            num, den = map(int, stream.get('avg_frame_rate', '0/0').split('/'))
+            fps = num / den if den else 0.0
+        except ValueError:
+            fps = 0.0
+        
         supported_codecs = ['h264', 'hevc', 'vp8', 'vp9', 'mpeg4', 'mjpeg']
         if codec not in supported_codecs:
             print(f"⚠️ Warning: Uncommon codec detected: {codec}, transcoding may take longer")
         
         print(f"✓ Video validated: {width}x{height}, {duration:.1f}s, {codec}")
         
-        return width, height
+        metadata = {
+            'width': width,
+            'height': height,
+            'duration': duration,
+            'codec': codec,
+            'fps': fps,
+            'bit_rate': int(stream.get('bit_rate') or data.get('format', {}).get('bit_rate') or 0),
+            'nb_frames': int(stream.get('nb_frames') or 0),
+            'has_audio': any(s.get('codec_type') == 'audio' for s in streams)
+        }
+        metadata.update(packet_stats if packet_stats is not None else probe_packet_stats(input_file, head))
+        
+        return metadata
         
     except json.JSONDecodeError as e:
         raise Exception(f"Corrupted video file: {e}")
@@ -85,19 +615,101 @@ def get_video_dimensions(input_file):
         raise Exception(f"Video validation failed: {str(e)}")
 
 
-def generate_variant_with_resource_management(input_file, output_dir, profile, source_width=None, source_height=None):
-    """Wrapper to manage resources during parallel transcoding"""
-    with memory_semaphore:  # Acquire semaphore before processing
-        return generate_variant(input_file, output_dir, profile, source_width, source_height)
+def probe_packet_stats(input_file, head=None):
+    """Summarise packet sizes over the first seconds of video as a motion proxy
+    
+    Large swings in inter-frame packet size mean the encoder is spending bits
+    on motion and scene changes; uniform small packets mean static content.
+    """
+    args = [
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-read_intervals', f"%+{PACKET_SAMPLE_SECONDS}",
+        '-show_entries', 'packet=size,flags',
+        '-of', 'csv=p=0'
+    ]
+    
+    try:
+        result = run_ffprobe(args, input_file, head)
+    except subprocess.TimeoutExpired:
+        return {}
+    
+    if result.returncode != 0:
+        return {}
+    
+    packets = []
+    for line in result.stdout.splitlines():
+        size, _, flags = line.partition(',')
+        if size.isdigit():
+            packets.append((int(size), 'K' in flags))
+    
+    return summarise_packets(packets)
 
 
-def generate_variant(input_file, output_dir, profile, source_width=None, source_height=None):
-    quality_dir = os.path.join(output_dir, profile['name'])
-    os.makedirs(quality_dir, exist_ok=True)
+def summarise_packets(packets):
+    """Mean and spread of inter-frame packet sizes, plus the keyframe interval
     
-    playlist_path = os.path.join(quality_dir, 'playlist.m3u8')
-    segment_pattern = os.path.join(quality_dir, 'segment_%03d.ts')
+    packets yields (size, is_keyframe); keyframes are counted but left out of
+    the size statistics since their size says little about motion.
+    """
+    sizes = []
+    keyframes = 0
+    for size, is_keyframe in packets:
+        if is_keyframe:
+            keyframes += 1
+        else:
+            sizes.append(size)
     
+    if len(sizes) < 2:
+        return {}
+    
+    mean = sum(sizes) / len(sizes)
+    variance = sum((s - mean) ** 2 for s in sizes) / len(sizes)
+    
+    return {
+        'packet_size_mean': mean,
+        'packet_size_cv': (variance ** 0.5) / mean if mean else 0.0,
+        'gop_size': (len(sizes) + keyframes) / max(keyframes, 1)
+    }
+
+
+def select_preset(profile, metadata):
+    """Pick an x264 preset for this profile from cheap source features
+    
+    Static, low bits-per-pixel sources lose nothing visible at a faster preset,
+    while high-motion sources keep the profile's preset (or a slower one) to
+    avoid blocking. Falls back to the profile's preset when stats are missing.
+    """
+    preset = profile.get('preset', 'faster')
+    
+    pixel_rate = metadata['width'] * metadata['height'] * (metadata.get('fps') or 30)
+    if not metadata.get('bit_rate') or 'packet_size_cv' not in metadata:
+        return preset
+    
+    bits_per_pixel = metadata['bit_rate'] / pixel_rate
+    motion = metadata['packet_size_cv']
+    
+    index = X264_PRESETS.index(preset)
+    if bits_per_pixel < EASY_CONTENT_BPP and motion < EASY_CONTENT_MOTION:
+        index -= 1
+    elif motion > HARD_CONTENT_MOTION:
+        index += 1
+    
+    return X264_PRESETS[max(0, min(index, len(X264_PRESETS) - 1))]
+
+
+def get_parallel_job_count(job_count):
+    """Size the encode pool to available CPUs and current memory headroom"""
+    workers = min(job_count, MAX_PARALLEL_JOBS, (os.cpu_count() or FFMPEG_THREADS) // FFMPEG_THREADS)
+    
+    metrics = memory_manager.monitor.last_metrics
+    if metrics:
+        workers = min(workers, int(metrics.available_mb // ENCODE_MEMORY_MB))
+    
+    return max(1, workers)
+
+
+def build_video_filter(profile, source_width=None, source_height=None):
     # Determine video filter based on orientation
     if profile.get('orientation') == 'portrait' and source_width and source_height:
         # Portrait: Crop center 9:16 from 16:9 source, then scale to target resolution
@@ -107,91 +719,351 @@ def generate_variant(input_file, output_dir, profile, source_width=None, source_
         crop_x = int((source_width - crop_width) / 2)
         
         # Crop to 9:16, then scale to target portrait resolution
-        vf = f"crop={crop_width}:{source_height}:{crop_x}:0,scale={profile['width']}:{profile['height']}"
         print(f"  Portrait crop: {crop_width}x{source_height} from center of {source_width}x{source_height}")
-    else:
-        # Landscape: Standard scaling with aspect ratio preservation
-        vf = f"scale={profile['width']}:{profile['height']}:force_original_aspect_ratio=decrease,pad={profile['width']}:{profile['height']}"
+        return f"crop={crop_width}:{source_height}:{crop_x}:0,scale={profile['width']}:{profile['height']}"
     
-    cmd = [
-        'ffmpeg',
+    # Landscape: Standard scaling with aspect ratio preservation
+    return profile['scale_filter']
+
+
+def video_encoder_args(profile, index, threads):
+    """Encoder selection and tuning arguments for output video stream index
+    
+    threads is this rendition's share of the invocation's thread budget; only
+    libx264 uses it, the hardware encoders manage their own.
+    """
+    if VIDEO_ENCODER == 'h264_nvenc':
+        return [
+            f'-c:v:{index}', 'h264_nvenc',
+            f'-profile:v:{index}', profile['profile'],
+            f'-level:v:{index}', profile['level'],
+            f'-preset:v:{index}', 'p4',
+            f'-tune:v:{index}', 'hq',
+            f'-rc:v:{index}', 'vbr',
+            f'-forced-idr:v:{index}', '1'
+        ]
+    
+    if VIDEO_ENCODER == 'h264_qsv':
+        return [
+            f'-c:v:{index}', 'h264_qsv',
+            f'-profile:v:{index}', profile['profile'],
+            f'-preset:v:{index}', 'faster',
+            f'-forced_idr:v:{index}', '1'
+        ]
+    
+    if VIDEO_ENCODER == 'h264_vaapi':
+        # VAAPI only offers the constrained variant of baseline
+        vaapi_profile = 'constrained_baseline' if profile['profile'] == 'baseline' else profile['profile']
+        return [
+            f'-c:v:{index}', 'h264_vaapi',
+            f'-profile:v:{index}', vaapi_profile
+        ]
+    
+    return [
+        f'-threads:v:{index}', str(threads),
+        f'-c:v:{index}', 'libx264',
+        f'-profile:v:{index}', profile['profile'],
+        f'-level:v:{index}', profile['level'],
+        f'-preset:v:{index}', profile.get('preset', 'faster')
+    ]
+
+
+def split_encoder_threads(profiles):
+    """Per-rung encoder thread counts for one ladder pass, weighted by pixel rate
+    
+    Every rung gets at least one thread (x264's minimum) and the rest of the
+    budget goes by width x height x fps (30 when the profile keeps the
+    source rate), so the largest rung is not left single-threaded while the
+    small ones idle. A pass asks for exactly max(FFMPEG_THREADS, len(profiles))
+    encoder threads in total.
+    """
+    budget = max(FFMPEG_THREADS, len(profiles))
+    rates = [p['width'] * p['height'] * p.get('fps', 30) for p in profiles]
+    spare = budget - len(profiles)
+    shares = [spare * rate / sum(rates) for rate in rates]
+    threads = [1 + int(share) for share in shares]
+    
+    # Threads lost to rounding go to the rungs that lost the most
+    by_remainder = sorted(range(len(profiles)), key=lambda i: shares[i] - int(shares[i]), reverse=True)
+    for i in by_remainder[:budget - sum(threads)]:
+        threads[i] += 1
+    
+    return threads
+
+
+def build_ladder_cmd(input_file, output_dir, profiles, source_width=None, source_height=None, has_audio=True):
+    """ffmpeg command encoding every profile into one HLS muxer
+    
+    The decoded video is fanned out with a split filter so each profile only
+    pays for its own scale and encode. Each profile becomes one rendition of
+    -var_stream_map, written to <output_dir>/<name>/playlist.m3u8.
+    """
+    labels = ''.join(f"[v{i}]" for i in range(len(profiles)))
+    filter_graph = [f"[0:v]split={len(profiles)}{labels}"]
+    for i, profile in enumerate(profiles):
+        filter_graph.append(
+            f"[v{i}]{build_video_filter(profile, source_width, source_height)}{HW_UPLOAD_FILTER.get(VIDEO_ENCODER, '')}[o{i}]"
+        )
+    
+    cmd = ['ffmpeg', '-nostats', '-loglevel', 'error'] + HW_DEVICE_ARGS.get(VIDEO_ENCODER, [])
+    if VIDEO_ENCODER == 'h264_nvenc':
+        # Decode on the GPU; frames come back to system memory for the CPU filters
+        cmd.extend(['-hwaccel', 'cuda'])
+    
+    cmd.extend([
         '-i', input_file,
-        '-c:v', 'libx264',
-        '-profile:v', profile['profile'],
-        '-level', profile['level'],
-        '-preset', 'fast',
-        '-b:v', profile['video_bitrate'],
-        '-maxrate', profile['maxrate'],
-        '-bufsize', profile['bufsize'],
-        '-vf', vf,
-        '-c:a', 'aac',
-        '-b:a', profile['audio_bitrate'],
-        '-ar', '48000',
-        '-ac', '2',
-        '-hls_time', '6',
+        '-filter_threads', '1',
+        '-filter_complex_threads', '1',
+        '-filter_complex', ';'.join(filter_graph)
+    ])
+    
+    # -threads:v:N is per rendition, so the pass's budget is divided between its rungs
+    rung_threads = split_encoder_threads(profiles)
+    
+    stream_map = []
+    for i, profile in enumerate(profiles):
+        os.makedirs(f"{output_dir}/{profile['name']}", exist_ok=True)
+        
+        cmd.extend(['-map', f"[o{i}]"])
+        cmd.extend(video_encoder_args(profile, i, rung_threads[i]))
+        cmd.extend([
+            f'-b:v:{i}', profile['video_bitrate'],
+            f'-maxrate:v:{i}', profile['maxrate'],
+            f'-bufsize:v:{i}', profile['bufsize']
+        ])
+        if 'fps' in profile:
+            cmd.extend([f'-r:v:{i}', str(profile['fps'])])
+        
+        if has_audio:
+            # Each rendition carries its own audio at the profile's bitrate
+            cmd.extend(['-map', '0:a:0', f'-b:a:{i}', profile['audio_bitrate']])
+            stream_map.append(f"v:{i},a:{i},name:{profile['name']}")
+        else:
+            stream_map.append(f"v:{i},name:{profile['name']}")
+    
+    if has_audio:
+        cmd.extend(['-c:a', 'aac', '-ar', '48000', '-ac', '2'])
+    
+    cmd.extend([
+        '-force_key_frames', f"expr:gte(t,n_forced*{SEGMENT_SECONDS})",
+        '-sc_threshold', '0'
+    ])
+    
+    cmd.extend([
+        '-f', 'hls',
+        '-var_stream_map', ' '.join(stream_map),
+        '-hls_time', str(SEGMENT_SECONDS),
         '-hls_playlist_type', 'vod',
-        '-hls_segment_filename', segment_pattern,
-        '-hls_flags', 'independent_segments',
-        '-g', '48',
-        '-keyint_min', '48',
+        '-hls_segment_filename', os.path.join(output_dir, '%v', 'segment_%03d.ts'),
+        # temp_file: segments appear under their final name only once complete
+        '-hls_flags', 'independent_segments+temp_file',
         '-hls_list_size', '0',
-        playlist_path
-    ]
+        os.path.join(output_dir, '%v', 'playlist.m3u8')
+    ])
     
-    if 'fps' in profile:
-        cmd.extend(['-r', str(profile['fps'])])
+    return cmd
+
+
+async def generate_all_variants(input_file, output_dir, profiles, source_width=None, source_height=None, input_stream=None,
+                                has_audio=True):
+    """Encode every profile from a single decode of the input
     
-    print(f"Generating {profile['name']}...")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    When input_stream is given, ffmpeg reads its chunks from stdin instead of
+    opening input_file.
+    At most MAX_PARALLEL_JOBS of these run at once, and a pass still running
+    after ENCODE_TIMEOUT seconds is killed so it cannot hold its slot forever.
+    """
+    cmd = build_ladder_cmd(
+        'pipe:0' if input_stream is not None else input_file,
+        output_dir, profiles, source_width, source_height, has_audio
+    )
     
-    if result.returncode != 0:
-        print(f"Error generating {profile['name']}: {result.stderr}")
+    names = ', '.join(p['name'] for p in profiles)
+    async with encode_slots, encoder_sessions.reserve(len(profiles)):
+        print(f"Generating {names}...")
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE if input_stream is not None else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        
+        memory_manager.notify_allocation()
+        
+        feeder = None
+        if input_stream is not None:
+            feeder = asyncio.ensure_future(feed_stdin(proc, input_stream))
+        
+        # Keep only the tail of ffmpeg's log for error reports
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        
+        def keep(line):
+            stderr_tail.append(line[:STDERR_LINE_MAX].decode('utf-8', errors='replace').rstrip())
+        
+        async def run_to_completion():
+            partial = b''
+            while True:
+                chunk = await proc.stderr.read(STDERR_READ_SIZE)
+                if not chunk:
+                    break
+                *lines, partial = (partial + chunk).split(b'\n')
+                for line in lines:
+                    keep(line)
+                partial = partial[:STDERR_LINE_MAX]
+            if partial:
+                keep(partial)
+            await proc.wait()
+            if feeder:
+                await feeder
+        
+        try:
+            await asyncio.wait_for(run_to_completion(), ENCODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            stderr_tail.append(f"Timed out after {ENCODE_TIMEOUT}s")
+        except Exception as e:
+            stderr_tail.append(f"Lost track of ffmpeg: {e}")
+        finally:
+            # Never leave a stalled or orphaned ffmpeg behind the released slot
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+            if feeder and not feeder.done():
+                feeder.cancel()
+    
+    if proc.returncode != 0:
+        stderr = '\n'.join(stderr_tail)
+        print(f"Error generating {names}: {stderr}")
         return False
     
-    print(f"✓ {profile['name']} generated successfully")
+    print(f"✓ {names} generated successfully")
     return True
 
 
-def verify_segments(output_dir, applicable_profiles):
+async def feed_stdin(proc, chunks):
+    """Copy chunks into ffmpeg's stdin, killing it if the source fails
+    
+    chunks blocks while waiting on the download, so each chunk is fetched in
+    the default executor to keep the encode loop free.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exited early; its return code reports the failure
+        pass
+    except Exception as e:
+        # Never let ffmpeg finish "successfully" on a truncated input
+        print(f"Input stream failed: {e}")
+        proc.kill()
+    finally:
+        try:
+            proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+async def encode_from_download(download, output_dir, profiles, source_width, source_height, has_audio=True):
+    """Run one ladder pass over the input, streaming it if still downloading
+    
+    While the input is still downloading ffmpeg is fed from the growing file.
+    Inputs that cannot be demuxed from a pipe (e.g. MP4 with the index at the
+    end) are retried from the complete download.
+    """
+    if not download.finished:
+        success = await generate_all_variants(
+            download.path, output_dir, profiles, source_width, source_height,
+            input_stream=download.follow(), has_audio=has_audio
+        )
+        if success:
+            return True
+        print("Streaming encode failed, retrying from the complete download")
+    
+    input_file = await asyncio.get_running_loop().run_in_executor(None, download.wait)
+    return await generate_all_variants(
+        input_file, output_dir, profiles, source_width, source_height, has_audio=has_audio
+    )
+
+
+async def transcode_profiles(download, output_dir, profiles, source_width, source_height, on_done, has_audio=True):
+    """Encode a group of profiles in one ffmpeg pass, returning the number that failed"""
+    try:
+        success = await encode_from_download(download, output_dir, profiles, source_width, source_height,
+                                             has_audio=has_audio)
+    except Exception as e:
+        print(f"Failed to generate {', '.join(p['name'] for p in profiles)}: {e}")
+        success = False
+    
+    # on_done writes status to GCS; keep that off the encode loop
+    loop = asyncio.get_running_loop()
+    for profile in profiles:
+        await loop.run_in_executor(None, on_done, profile, success)
+    
+    return 0 if success else len(profiles)
+
+
+def verify_segments(output_dir, applicable_profiles, uploaded=None):
+    """Check every segment referenced by each variant playlist exists
+    
+    A segment counts as present if it is still on disk or was already
+    streamed to GCS (uploaded maps a directory to the names uploaded from it).
+    """
+    uploaded = uploaded or {}
+    
     for profile in applicable_profiles:
-        quality_dir = os.path.join(output_dir, profile['name'])
-        playlist_path = os.path.join(quality_dir, 'playlist.m3u8')
+        quality_dir = f"{output_dir}/{profile['name']}"
+        playlist_path = f"{quality_dir}/playlist.m3u8"
         
-        with open(playlist_path, 'r') as f:
-            playlist_content = f.read()
+        # One directory read instead of a stat per segment
+        present = {entry.name for entry in os.scandir(quality_dir)}
+        present |= uploaded.get(quality_dir, set())
         
-        import re
-        segments = re.findall(r'segment_\d+\.ts', playlist_content)
-        
-        for segment in segments:
-            segment_path = os.path.join(quality_dir, segment)
-            if not os.path.exists(segment_path):
-                print(f"❌ Missing segment: {segment_path}")
-                return False
+        segments = _SEG_RE.findall(Path(playlist_path).read_text())
+        missing = [segment for segment in segments if segment not in present]
+        if missing:
+            print(f"❌ Missing segment: {quality_dir}/{missing[0]}")
+            return False
         
         print(f"✓ Verified {len(segments)} segments for {profile['name']}")
     
     return True
 
 
+@functools.lru_cache(maxsize=64)
+def build_master_playlist(profiles_key):
+    """Master playlist text for a set of variants; deterministic, so cached
+    
+    profiles_key is a tuple of (name, width, height, bandwidth) per variant.
+    """
+    parts = ['#EXTM3U\n#EXT-X-VERSION:6\n\n']
+    
+    for name, width, height, bandwidth in profiles_key:
+        parts.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height}\n")
+        parts.append(f"../{name}/playlist.m3u8\n\n")
+    
+    return ''.join(parts)
+
+
 def generate_master_playlist(output_dir, applicable_profiles):
     manifest_dir = os.path.join(output_dir, 'manifest')
     os.makedirs(manifest_dir, exist_ok=True)
     
     master_path = os.path.join(manifest_dir, 'master.m3u8')
     
-    content = '#EXTM3U\n#EXT-X-VERSION:6\n\n'
-    
-    for profile in applicable_profiles:
-        video_bps = int(profile['video_bitrate'].replace('k', '')) * 1000
-        audio_bps = int(profile['audio_bitrate'].replace('k', '')) * 1000
-        bandwidth = video_bps + audio_bps
-        
-        content += f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={profile['width']}x{profile['height']}\n"
-        content += f"../{profile['name']}/playlist.m3u8\n\n"
+    profiles_key = tuple(
+        (p['name'], p['width'], p['height'], p['bandwidth_bps'])
+        for p in applicable_profiles
+    )
     
     with open(master_path, 'w') as f:
-        f.write(content)
+        f.write(build_master_playlist(profiles_key))
     
     print('✓ Master playlist generated')
 
@@ -202,12 +1074,15 @@ def generate_thumbnails(input_file, output_dir):
     
     poster_path = os.path.join(thumbnails_dir, 'poster.jpg')
     
+    # Seeking before -i jumps to the nearest keyframe instead of decoding up to 1s
     cmd = [
         'ffmpeg',
-        '-i', input_file,
         '-ss', '00:00:01',
-        '-vframes', '1',
+        '-noaccurate_seek',
+        '-i', input_file,
+        '-frames:v', '1',
         '-q:v', '2',
+        '-an', '-sn',
         poster_path
     ]
     
@@ -215,83 +1090,260 @@ def generate_thumbnails(input_file, output_dir):
     print('✓ Poster thumbnail generated')
 
 
-def update_processing_status(video_id, completed, total, has_portrait=False):
-    """Update real-time processing status in GCS metadata"""
-    try:
-        bucket = storage_client.bucket(GCS_OUTPUT_BUCKET)
-        status_blob = bucket.blob(f"videos/{video_id}/status.json")
-        
-        metadata = {
-            "status": "processing",
-            "progress": f"{completed}/{total}",
-            "percentage": round((completed / total) * 100, 1),
-            "completed_variants": completed,
-            "total_variants": total,
-            "has_portrait": has_portrait
-        }
+class StatusPublisher:
+    """Coalesce status.json writes for one video
+    
+    Progress updates only record the latest state; a background thread
+    uploads it at most every STATUS_FLUSH_INTERVAL seconds, so a burst of
+    finished variants costs one GCS write instead of one each. Terminal
+    states (failed/completed) are flushed synchronously.
+    
+    The first write replaces whatever an earlier run left; later writes are
+    conditional on the generation this publisher last saw. When another
+    writer gets in between, status.json is re-read: a terminal state there is
+    kept and this publisher stops writing, while a progress state is replaced
+    with ours at the fresh generation.
+    """
+    
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.blob = get_storage_client().bucket(GCS_OUTPUT_BUCKET).blob(f"videos/{video_id}/status.json")
+        self._latest = None
+        self._dirty = False
+        self._generation = None
+        self._superseded = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+    
+    def set(self, completed, total, has_portrait=False):
+        """Record progress; it is written by the next periodic flush"""
+        with self._lock:
+            self._latest = {
+                "status": "processing",
+                "progress": f"{completed}/{total}",
+                "percentage": round((completed / total) * 100, 1),
+                "completed_variants": completed,
+                "total_variants": total,
+                "has_portrait": has_portrait
+            }
+            self._dirty = True
+    
+    def fail(self, error_message):
+        """Write the failed state immediately"""
+        self._set_terminal({
+            "status": "failed",
+            "error": error_message,
+            "percentage": 0
+        })
+        print(f"Status updated to failed: {error_message}")
+    
+    def complete(self, source_uri, has_portrait, variants, pending_variants):
+        """Write the completed state immediately, recording what on-demand variants need"""
+        self._set_terminal({
+            "status": "completed",
+            "percentage": 100,
+            "has_portrait": has_portrait,
+            "source_uri": source_uri,
+            "variants": variants,
+            "pending_variants": pending_variants
+        })
+        print(f"Status updated to completed ({len(pending_variants)} variant(s) available on demand)")
+    
+    def _set_terminal(self, metadata):
+        with self._lock:
+            self._latest = metadata
+            self._dirty = True
+        self.flush()
+    
+    def _run(self):
+        while not self._stop.wait(STATUS_FLUSH_INTERVAL):
+            self.flush()
+    
+    def flush(self):
+        """Upload the latest state if it has changed since the last write"""
+        from google.api_core.exceptions import PreconditionFailed
         
-        status_blob.upload_from_string(
-            json.dumps(metadata),
-            content_type='application/json'
-        )
-        print(f"Status updated: {completed}/{total} variants complete")
-    except Exception as e:
-        print(f"Failed to update status: {e}")
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty or self._superseded:
+                    return
+                metadata = self._latest
+                self._dirty = False
+            
+            for attempt in range(STATUS_UPDATE_ATTEMPTS):
+                try:
+                    self.blob.upload_from_string(
+                        json.dumps(metadata),
+                        content_type='application/json',
+                        if_generation_match=self._generation
+                    )
+                    self._generation = self.blob.generation
+                    if metadata['status'] == 'processing':
+                        print(f"Status updated: {metadata['progress']} variants complete")
+                    return
+                except PreconditionFailed:
+                    try:
+                        current, self._generation = read_processing_status(self.video_id)
+                    except Exception as e:
+                        print(f"Failed to re-read status after a conflicting write: {e}")
+                        return
+                    if current and current.get('status') in ('failed', 'completed'):
+                        print(f"status.json was set to {current['status']} by another writer, leaving it")
+                        self._superseded = True
+                        return
+                except Exception as e:
+                    print(f"Failed to update status: {e}")
+                    return
+            
+            print(f"status.json for {self.video_id} kept changing, dropping this update")
 
 
-def update_processing_status_failed(video_id, error_message):
-    """Update status to failed state"""
+def read_processing_status(video_id):
+    """Fetch status.json for a video and the generation it was read at
+    
+    Returns (None, 0) if it doesn't exist; a generation of 0 makes a
+    conditional write succeed only if the object is still absent.
+    """
+    from google.api_core.exceptions import NotFound
+    
+    bucket = get_storage_client().bucket(GCS_OUTPUT_BUCKET)
+    status_blob = bucket.blob(f"videos/{video_id}/status.json")
+    
     try:
-        bucket = storage_client.bucket(GCS_OUTPUT_BUCKET)
-        status_blob = bucket.blob(f"videos/{video_id}/status.json")
-        
-        metadata = {
-            "status": "failed",
-            "error": error_message,
-            "percentage": 0
-        }
+        status_blob.reload()
+        data = status_blob.download_as_bytes(if_generation_match=status_blob.generation)
+    except NotFound:
+        return None, 0
+    return json.loads(data), status_blob.generation
+
+
+def update_processing_status(video_id, update):
+    """Read-modify-write status.json, conditional on the generation read
+    
+    update(status) returns the new status, or None to leave it unchanged.
+    If another writer gets in between the read and the write, the status is
+    re-read and update() runs again on the fresh copy.
+    """
+    from google.api_core.exceptions import PreconditionFailed
+    
+    blob = get_storage_client().bucket(GCS_OUTPUT_BUCKET).blob(f"videos/{video_id}/status.json")
+    
+    for attempt in range(STATUS_UPDATE_ATTEMPTS):
+        status, generation = read_processing_status(video_id)
+        new_status = update(status)
+        if new_status is None:
+            return status
         
-        status_blob.upload_from_string(
-            json.dumps(metadata),
-            content_type='application/json'
-        )
-        print(f"Status updated to failed: {error_message}")
-    except Exception as e:
-        print(f"Failed to update failure status: {e}")
+        try:
+            blob.upload_from_string(
+                json.dumps(new_status),
+                content_type='application/json',
+                if_generation_match=generation
+            )
+            return new_status
+        except PreconditionFailed:
+            print(f"status.json for {video_id} changed underneath us, re-reading")
+    
+    raise Exception(f"status.json for {video_id} kept changing, gave up after {STATUS_UPDATE_ATTEMPTS} attempts")
 
 
-def upload_to_gcs(local_dir, video_id):
-    bucket = storage_client.bucket(GCS_OUTPUT_BUCKET)
+def _iter_files(root):
+    """Yield a DirEntry for every file under root"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_files(entry.path)
+            else:
+                yield entry
+
+
+def upload_to_gcs(local_dir, video_id, filenames=None):
+    """Upload local_dir (or just the given paths relative to it) to the video's prefix"""
+    from google.cloud.storage import transfer_manager
     
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, local_dir)
-            blob_path = f"videos/{video_id}/{relative_path}"
-            
-            blob = bucket.blob(blob_path)
-            blob.upload_from_filename(local_path)
-            print(f"Uploaded: {blob_path}")
+    bucket = get_storage_client().bucket(GCS_OUTPUT_BUCKET)
+    
+    if filenames is None:
+        prefix_len = len(os.path.join(local_dir, ''))
+        sizes = {entry.path[prefix_len:]: entry.stat().st_size for entry in _iter_files(local_dir)}
+    else:
+        sizes = {name: os.path.getsize(f"{local_dir}/{name}") for name in filenames}
+    filenames = list(sizes)
+    
+    small, large = [], []
+    for name, size in sizes.items():
+        (large if size > LARGE_UPLOAD_BYTES else small).append(name)
     
-    print(f'✓ All files uploaded to gs://{GCS_OUTPUT_BUCKET}/videos/{video_id}/')
+    results = transfer_manager.upload_many_from_filenames(
+        bucket,
+        small,
+        source_directory=local_dir,
+        blob_name_prefix=f"videos/{video_id}/",
+        blob_constructor_kwargs={'chunk_size': UPLOAD_CHUNK_SIZE},
+        # CRC32C is hardware-accelerated, unlike the default MD5
+        upload_kwargs={'checksum': 'crc32c', 'timeout': UPLOAD_TIMEOUT},
+        worker_type=transfer_manager.THREAD,
+        max_workers=UPLOAD_WORKERS
+    )
+    
+    for name in large:
+        try:
+            transfer_manager.upload_chunks_concurrently(
+                os.path.join(local_dir, name),
+                bucket.blob(f"videos/{video_id}/{name}"),
+                chunk_size=UPLOAD_CHUNK_SIZE,
+                worker_type=transfer_manager.THREAD,
+                max_workers=UPLOAD_WORKERS,
+                checksum='crc32c',
+                timeout=UPLOAD_TIMEOUT
+            )
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    
+    failed = [(name, result) for name, result in zip(small + large, results) if isinstance(result, Exception)]
+    for name, error in failed:
+        print(f"❌ Failed to upload {name}: {error}")
+    if failed:
+        raise Exception(f"{len(failed)} of {len(filenames)} files failed to upload")
+    
+    print(f'✓ All {len(filenames)} files uploaded to gs://{GCS_OUTPUT_BUCKET}/videos/{video_id}/')
+
+
+def profiles_within(profiles, widths, heights, width, height):
+    """Profiles no larger than width x height, from a ladder ordered by size"""
+    cutoff = min(bisect_right(widths, width), bisect_right(heights, height))
+    return profiles[:cutoff]
 
 
 def process_video(input_uri, video_id):
     bucket_name = input_uri.replace('gs://', '').split('/')[0]
     blob_path = '/'.join(input_uri.replace('gs://', '').split('/')[1:])
     
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(blob_path)
     
-    with tempfile.TemporaryDirectory() as temp_dir:
-        input_file = os.path.join(temp_dir, 'input_video')
-        output_dir = os.path.join(temp_dir, 'output')
-        os.makedirs(output_dir)
-        
-        print(f"Downloading {input_uri}...")
-        blob.download_to_filename(input_file)
+    print(f"Downloading {input_uri}...")
+    with StatusPublisher(video_id) as status, \
+            scratch_directory(video_id) as temp_dir, \
+            scratch_directory(video_id, INPUT_ROOT) as input_dir, \
+            InputDownload(blob, os.path.join(input_dir, 'input_video')) as download, \
+            SegmentUploader(os.path.join(temp_dir, 'output'), video_id) as uploader:
+        output_dir = uploader.local_dir
         
-        width, height = get_video_dimensions(input_file)
+        metadata = probe_input(download)
+        width, height, has_audio = metadata['width'], metadata['height'], metadata['has_audio']
         print(f"Video dimensions: {width}x{height}")
         
         # Detect 16:9 aspect ratio (with tolerance for encoding variations)
@@ -304,33 +1356,44 @@ def process_video(input_uri, video_id):
             os.makedirs(landscape_output_dir, exist_ok=True)
             print(f"🎬 Detected 16:9 video - will generate both landscape (4K) and portrait (1080p) versions")
         
+        # Premium rungs in LAZY_PROFILES are left for /transcode-variant
         applicable_profiles = [
-            p for p in LANDSCAPE_PROFILES
-            if p['width'] <= width and p['height'] <= height
+            dict(p, preset=select_preset(p, metadata))
+            for p in profiles_within(EAGER_PROFILES, EAGER_WIDTHS, EAGER_HEIGHTS, width, height)
         ]
+        lazy_profiles = profiles_within(LAZY_PROFILES, LAZY_WIDTHS, LAZY_HEIGHTS, width, height)
+        portrait_profiles = [dict(p, preset=select_preset(p, metadata)) for p in PORTRAIT_PROFILES]
+        presets = ', '.join(f"{p['name']}={p['preset']}" for p in applicable_profiles)
+        print(f"  x264 presets: {presets}")
         
         # Group profiles by priority for smarter processing
         critical_profiles = [p for p in applicable_profiles if p['height'] <= 480]  # 144p-480p
-        standard_profiles = [p for p in applicable_profiles if 480 < p['height'] <= 1080]  # 540p-1080p
-        premium_profiles = [p for p in applicable_profiles if p['height'] > 1080]  # 1440p-4K
+        standard_profiles = [p for p in applicable_profiles if p['height'] > 480]  # 540p-1080p
         
         total_variants = len(applicable_profiles)
         if is_16_9:
             total_variants += len(PORTRAIT_PROFILES)  # Add portrait variant count
         
         print(f"Generating {total_variants} quality variants in parallel...")
-        print(f"  Landscape - Critical: {len(critical_profiles)}, Standard: {len(standard_profiles)}, Premium: {len(premium_profiles)}")
+        print(f"  Landscape - Critical: {len(critical_profiles)}, Standard: {len(standard_profiles)}")
         if is_16_9:
             print(f"  Portrait: {len(PORTRAIT_PROFILES)} variant(s)")
         
         # Track successful profiles for downstream processing
         successful_profiles = []
-        failed_count = 0
         
-        # Process in strict priority order with controlled parallelism
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_JOBS) as executor:
-            
-            # Process critical profiles first (COMPLETE before moving on)
+        def on_variant_done(profile, success):
+            if success:
+                successful_profiles.append(profile)
+            status.set(len(successful_profiles), total_variants, is_16_9)
+        
+        portrait_output_dir = os.path.join(output_dir, 'portrait')
+        if is_16_9 and PORTRAIT_PROFILES:
+            os.makedirs(portrait_output_dir, exist_ok=True)
+        
+        async def encode_landscape():
+            # Process in strict priority order; each phase completes before the next starts
+            failed = 0
             if critical_profiles:
                 # Check memory before starting (critical profiles always run unless emergency)
                 mem_status = memory_manager.get_status()
@@ -338,93 +1401,42 @@ def process_video(input_uri, video_id):
                     print("⚠️ WARNING: Emergency memory mode - only processing critical profiles")
                 
                 print("Processing critical profiles...")
-                critical_futures = {
-                    executor.submit(generate_variant_with_resource_management, input_file, landscape_output_dir, p, width, height): p
-                    for p in critical_profiles
-                }
-                
-                for future in concurrent.futures.as_completed(critical_futures):
-                    profile = critical_futures[future]
-                    try:
-                        if future.result(timeout=600):
-                            successful_profiles.append(profile)
-                        else:
-                            failed_count += 1
-                    except Exception as e:
-                        print(f"Failed to generate {profile['name']}: {e}")
-                        failed_count += 1
-                    
-                    update_processing_status(video_id, len(successful_profiles), total_variants, is_16_9)
+                failed += await transcode_profiles(download, landscape_output_dir, critical_profiles, width, height, on_variant_done, has_audio)
             
             # Only process standard profiles after critical ones complete
             if standard_profiles and not memory_manager.should_skip_variant('standard'):
                 print("Processing standard profiles...")
-                standard_futures = {
-                    executor.submit(generate_variant_with_resource_management, input_file, landscape_output_dir, p, width, height): p
-                    for p in standard_profiles
-                }
-                
-                for future in concurrent.futures.as_completed(standard_futures):
-                    profile = standard_futures[future]
-                    try:
-                        if future.result(timeout=600):
-                            successful_profiles.append(profile)
-                        else:
-                            failed_count += 1
-                    except Exception as e:
-                        print(f"Failed to generate {profile['name']}: {e}")
-                        failed_count += 1
-                    
-                    update_processing_status(video_id, len(successful_profiles), total_variants, is_16_9)
+                failed += await transcode_profiles(download, landscape_output_dir, standard_profiles, width, height, on_variant_done, has_audio)
             
-            # Finally process premium profiles (skip if memory pressure)
-            if premium_profiles and not memory_manager.should_skip_variant('premium'):
-                print("Processing premium profiles...")
-                premium_futures = {
-                    executor.submit(generate_variant_with_resource_management, input_file, landscape_output_dir, p, width, height): p
-                    for p in premium_profiles
-                }
-                
-                for future in concurrent.futures.as_completed(premium_futures):
-                    profile = premium_futures[future]
-                    try:
-                        if future.result(timeout=600):
-                            successful_profiles.append(profile)
-                        else:
-                            failed_count += 1
-                    except Exception as e:
-                        print(f"Failed to generate {profile['name']}: {e}")
-                        failed_count += 1
-                    
-                    update_processing_status(video_id, len(successful_profiles), total_variants, is_16_9)
-            elif premium_profiles:
-                print("⚠️ Skipping premium profiles due to memory pressure")
+            return failed
+        
+        async def encode_portrait():
+            portrait_failed = await transcode_profiles(download, portrait_output_dir, portrait_profiles, width, height, on_variant_done, has_audio)
+            if portrait_failed:
+                print(f"⚠️ Portrait variant generation failed")
+            else:
+                print(f"✓ Portrait variant generated successfully")
+            return portrait_failed
+        
+        async def encode_all():
+            if not (is_16_9 and PORTRAIT_PROFILES):
+                return await encode_landscape()
             
-            # Generate portrait version for 16:9 videos
-            if is_16_9 and PORTRAIT_PROFILES:
-                portrait_output_dir = os.path.join(output_dir, 'portrait')
-                os.makedirs(portrait_output_dir, exist_ok=True)
-                
-                print("Processing portrait variant...")
-                portrait_futures = {
-                    executor.submit(generate_variant_with_resource_management, input_file, portrait_output_dir, p, width, height): p
-                    for p in PORTRAIT_PROFILES
-                }
-                
-                for future in concurrent.futures.as_completed(portrait_futures):
-                    profile = portrait_futures[future]
-                    try:
-                        if future.result(timeout=600):
-                            successful_profiles.append(profile)
-                            print(f"✓ Portrait variant generated successfully")
-                        else:
-                            failed_count += 1
-                            print(f"⚠️ Portrait variant generation failed")
-                    except Exception as e:
-                        print(f"Failed to generate portrait variant: {e}")
-                        failed_count += 1
-                    
-                    update_processing_status(video_id, len(successful_profiles), total_variants, is_16_9)
+            # The portrait ladder is independent of the landscape one, so overlap it
+            # with the landscape phases when there is CPU and memory headroom
+            if get_parallel_job_count(2) > 1:
+                print("Processing portrait variant alongside landscape...")
+                return sum(await asyncio.gather(encode_landscape(), encode_portrait()))
+            
+            failed = await encode_landscape()
+            print("Processing portrait variant...")
+            return failed + await encode_portrait()
+        
+        failed_count = run_encode(encode_all())
+        
+        # Thumbnails need random access, and a failed download must fail the job
+        input_file = download.wait()
+        uploader.finish()
         
         landscape_count = len([p for p in successful_profiles if p.get('orientation') != 'portrait'])
         portrait_count = len([p for p in successful_profiles if p.get('orientation') == 'portrait'])
@@ -436,7 +1448,7 @@ def process_video(input_uri, video_id):
         
         if len(successful_profiles) == 0:
             # Update status to failed
-            update_processing_status_failed(video_id, "All transcoding variants failed")
+            status.fail("All transcoding variants failed")
             raise Exception("All transcoding variants failed")
         
         # Only verify and use successful profiles
@@ -445,8 +1457,8 @@ def process_video(input_uri, video_id):
         
         # Verify landscape variants
         if landscape_profiles:
-            if not verify_segments(landscape_output_dir, landscape_profiles):
-                update_processing_status_failed(video_id, "Landscape segment verification failed")
+            if not verify_segments(landscape_output_dir, landscape_profiles, uploader.uploaded):
+                status.fail("Landscape segment verification failed")
                 raise Exception("Landscape segment verification failed")
             
             generate_master_playlist(landscape_output_dir, landscape_profiles)
@@ -454,8 +1466,7 @@ def process_video(input_uri, video_id):
         
         # Verify portrait variants (if 16:9)
         if is_16_9 and portrait_profiles_success:
-            portrait_output_dir = os.path.join(output_dir, 'portrait')
-            if not verify_segments(portrait_output_dir, portrait_profiles_success):
+            if not verify_segments(portrait_output_dir, portrait_profiles_success, uploader.uploaded):
                 print("⚠️ Portrait segment verification failed, but landscape succeeded")
             else:
                 generate_master_playlist(portrait_output_dir, portrait_profiles_success)
@@ -463,20 +1474,121 @@ def process_video(input_uri, video_id):
         
         upload_to_gcs(output_dir, video_id)
         
-        move_input_to_completed(bucket_name, blob_path)
+        mark_input_completed(bucket_name, blob_path)
+        
+        # The input stays where it was uploaded; on-demand variants encode from it
+        status.complete(
+            input_uri,
+            is_16_9,
+            [p['name'] for p in landscape_profiles],
+            [p['name'] for p in lazy_profiles]
+        )
+    
+    # The eager ladder is live; the premium rungs follow as one background job
+    if lazy_profiles and not submit_job(fill_lazy_variants, video_id, lazy_profiles):
+        print(f"Job backlog full, {video_id} premium variants left on demand")
     
     return True
 
 
-def move_input_to_completed(bucket_name, blob_path):
-    bucket = storage_client.bucket(bucket_name)
-    source_blob = bucket.blob(blob_path)
+def mark_input_completed(bucket_name, blob_path):
+    """Record the input as processed with an empty marker under completed/
     
-    new_path = blob_path.replace('pending/', 'completed/')
-    bucket.copy_blob(source_blob, bucket, new_path)
-    source_blob.delete()
+    Moving the input would copy every byte server-side; the marker is a
+    single small write. Inputs left in pending/ are removed by the bucket's
+    lifecycle rule.
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    marker_path = blob_path.replace('pending/', 'completed/') + '.done'
+    bucket.blob(marker_path).upload_from_string(b'')
     
-    print(f"Moved input file to completed: {new_path}")
+    print(f"Marked input as completed: {marker_path}")
+
+
+def generate_lazy_variants(video_id, profiles):
+    """Encode deferred premium variants and add them to the master playlist
+    
+    Uses the source recorded in status.json when the eager ladder completed;
+    every requested rung comes out of one download and one ffmpeg pass over
+    it. The master playlist and status.json are rewritten together under a
+    conditional write, so variants finished concurrently all end up listed.
+    """
+    status, _ = read_processing_status(video_id)
+    if not status or status.get('status') != 'completed':
+        raise Exception(f"Video {video_id} has not finished processing")
+    
+    available = status.get('variants', [])
+    for profile in profiles:
+        if profile['name'] not in available and profile['name'] not in status.get('pending_variants', []):
+            raise Exception(f"{profile['name']} is not applicable to {video_id}")
+    
+    profiles = [p for p in profiles if p['name'] not in available]
+    if not profiles:
+        print(f"Requested variants already available for {video_id}")
+        return
+    
+    names = [p['name'] for p in profiles]
+    source_uri = status['source_uri']
+    bucket_name = source_uri.replace('gs://', '').split('/')[0]
+    blob_path = '/'.join(source_uri.replace('gs://', '').split('/')[1:])
+    blob = get_storage_client().bucket(bucket_name).blob(blob_path)
+    
+    print(f"Generating {', '.join(names)} for {video_id} from {source_uri}...")
+    with scratch_directory(video_id) as temp_dir, \
+            scratch_directory(video_id, INPUT_ROOT) as input_dir, \
+            InputDownload(blob, os.path.join(input_dir, 'input_video')) as download, \
+            SegmentUploader(os.path.join(temp_dir, 'output'), video_id) as uploader:
+        output_dir = uploader.local_dir
+        variant_dir = os.path.join(output_dir, 'landscape') if status.get('has_portrait') else output_dir
+        
+        metadata = probe_input(download)
+        profiles = [dict(p, preset=select_preset(p, metadata)) for p in profiles]
+        
+        encode = encode_from_download(
+            download, variant_dir, profiles, metadata['width'], metadata['height'], has_audio=metadata['has_audio']
+        )
+        if not run_encode(encode):
+            raise Exception(f"Failed to generate {', '.join(names)}")
+        
+        uploader.finish()
+        if not verify_segments(variant_dir, profiles, uploader.uploaded):
+            raise Exception(f"{', '.join(names)} segment verification failed")
+        upload_to_gcs(output_dir, video_id)
+        
+        prefix_len = len(os.path.join(output_dir, ''))
+        master_name = os.path.join(variant_dir, 'manifest', 'master.m3u8')[prefix_len:]
+        
+        def add_variants(current):
+            added = [name for name in names if current and name not in current.get('variants', [])]
+            if not added:
+                return None  # Another request finished them first
+            
+            # Rebuilt from the status just read, so a concurrent variant is kept
+            variants = current['variants'] + added
+            generate_master_playlist(variant_dir, [p for p in LANDSCAPE_PROFILES if p['name'] in variants])
+            upload_to_gcs(output_dir, video_id, [master_name])
+            
+            return dict(
+                current,
+                variants=variants,
+                pending_variants=[name for name in current.get('pending_variants', []) if name not in added]
+            )
+        
+        update_processing_status(video_id, add_variants)
+    
+    print(f"✓ {', '.join(names)} added to {video_id}")
+
+
+def fill_lazy_variants(video_id, profiles):
+    """Background job encoding a video's deferred premium rungs together"""
+    if memory_manager.should_skip_variant('premium'):
+        print(f"⚠️ Skipping premium variants for {video_id} due to memory pressure; still available on demand")
+        return
+    
+    try:
+        generate_lazy_variants(video_id, profiles)
+    except Exception as e:
+        print(f"Error generating premium variants for {video_id}: {e}")
 
 
 @app.route('/process', methods=['POST'])
@@ -489,6 +1601,7 @@ def process():
     if not input_uri or not video_id:
         return jsonify({'error': 'Missing input_uri or video_id'}), 400
     
+    job_started()
     try:
         process_video(input_uri, video_id)
         return jsonify({
@@ -499,6 +1612,73 @@ def process():
     except Exception as e:
         print(f"Error processing video: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        job_finished()
+
+
+# Pub/Sub jobs run on a bounded pool instead of a thread per message, and at
+# most MAX_QUEUED_JOBS may be running or waiting at once
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', MAX_PARALLEL_JOBS * 2))
+_JOB_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_JOBS, thread_name_prefix='job')
+_job_slots = threading.BoundedSemaphore(MAX_QUEUED_JOBS)
+
+# A worker retires after finishing about this many transcode jobs (0 disables),
+# returning memory held across transcodes to the OS. Only jobs count, so health
+# checks and 429 nacks never retire a worker, and the jitter keeps workers that
+# started together from retiring together.
+MAX_JOBS_PER_WORKER = int(os.environ.get('MAX_JOBS_PER_WORKER', 0))
+_recycle_after = MAX_JOBS_PER_WORKER + random.randint(0, MAX_JOBS_PER_WORKER // 4)
+_jobs_lock = threading.Lock()
+_jobs_active = 0
+_jobs_finished = 0
+_retiring = False
+
+
+def job_started():
+    """Count a running or queued transcode job against this worker"""
+    global _jobs_active
+    with _jobs_lock:
+        _jobs_active += 1
+
+
+def job_finished():
+    """Retire the worker once it has reached its job limit and gone idle
+    
+    Past the limit the worker stops taking Pub/Sub jobs so it can drain; the
+    SIGTERM is sent only once nothing is running or queued, so gunicorn's
+    graceful shutdown is immediate and a replacement starts straight away.
+    """
+    global _jobs_active, _jobs_finished, _retiring
+    with _jobs_lock:
+        _jobs_active -= 1
+        _jobs_finished += 1
+        if not MAX_JOBS_PER_WORKER or _jobs_finished < _recycle_after:
+            return
+        _retiring = True
+        if _jobs_active:
+            return
+    
+    print(f"Worker finished {_jobs_finished} jobs, recycling")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def submit_job(fn, *args):
+    """Run fn on the job pool, or return False if the backlog is full
+    
+    A retiring worker also refuses, so the job is redelivered to another.
+    """
+    if _retiring or not _job_slots.acquire(blocking=False):
+        return False
+    
+    job_started()
+    
+    def done(_):
+        _job_slots.release()
+        job_finished()
+    
+    future = _JOB_EXECUTOR.submit(fn, *args)
+    future.add_done_callback(done)
+    return True
 
 
 @app.route('/process-pubsub', methods=['POST'])
@@ -528,13 +1708,11 @@ def process_pubsub():
         
         print(f"📨 Received Pub/Sub transcoding request for video: {video_id}")
         
-        # Process video asynchronously (return 200 immediately to ack message)
-        import threading
-        thread = threading.Thread(
-            target=process_video_with_error_handling,
-            args=(input_uri, video_id)
-        )
-        thread.start()
+        # Process video asynchronously (return 200 immediately to ack message);
+        # a full backlog nacks with 429 so Pub/Sub redelivers later
+        if not submit_job(process_video_with_error_handling, input_uri, video_id):
+            print(f"Job backlog full, deferring {video_id}")
+            return jsonify({'error': 'Transcoder busy', 'video_id': video_id}), 429
         
         return jsonify({'status': 'processing', 'video_id': video_id}), 200
         
@@ -543,6 +1721,39 @@ def process_pubsub():
         return jsonify({'error': str(e)}), 400
 
 
+@app.route('/transcode-variant', methods=['POST'])
+def transcode_variant():
+    """Generate a deferred premium variant on demand (e.g. on first playback)"""
+    data = request.get_json()
+    
+    video_id = data.get('video_id')
+    profile_name = data.get('profile')
+    
+    if not video_id or not profile_name:
+        return jsonify({'error': 'Missing video_id or profile'}), 400
+    
+    profile = next((p for p in LAZY_PROFILES if p['name'] == profile_name), None)
+    if not profile:
+        return jsonify({'error': f'Unknown on-demand profile: {profile_name}'}), 400
+    
+    if memory_manager.should_skip_variant('premium'):
+        return jsonify({'error': 'Insufficient memory, retry later'}), 503
+    
+    job_started()
+    try:
+        generate_lazy_variants(video_id, [profile])
+        return jsonify({
+            'status': 'success',
+            'video_id': video_id,
+            'profile': profile_name
+        })
+    except Exception as e:
+        print(f"Error generating on-demand variant: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        job_finished()
+
+
 def process_video_with_error_handling(input_uri, video_id):
     """Wrapper to handle errors in async processing"""
     try:
@@ -561,6 +1772,26 @@ def health():
     })
 
 
+def warm_up():
+    """Pay the ffmpeg and GCS client start-up costs before the first request
+    
+    Running `ffmpeg -version` pulls the binary and its codec libraries into
+    the page cache, and touching the output bucket imports the storage stack
+    and fetches credentials, so a cold container does not spend the first
+    request on either.
+    """
+    try:
+        subprocess.run(['ffmpeg', '-version'], capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"ffmpeg warm-up failed: {e}")
+    
+    try:
+        get_storage_client().bucket(GCS_OUTPUT_BUCKET).exists()
+    except Exception as e:
+        print(f"Storage warm-up failed: {e}")
+
+
 if __name__ == '__main__':
+    warm_up()
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)